@@ -1,16 +1,25 @@
+import asyncio
 import logging
 import os
-import subprocess
+import string
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional
+from urllib.parse import urlparse
 from zoneinfo import ZoneInfo
 
+import pygit2
 from dotenv import load_dotenv
-from telegram import Bot, ReactionTypeEmoji, Update
+from telegram import Bot, ReactionTypeEmoji, Update, User
 from telegram.error import BadRequest
-from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    ContextTypes,
+    MessageHandler,
+    filters,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +27,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("telegram2foam")
 
+# Keep automatic gc and fsmonitor startup off the per-message path.
+GIT_FAST_FLAGS = ("-c", "gc.auto=0", "-c", "core.fsmonitor=false")
+
 
 def load_template(path: Path, default: str) -> str:
     try:
@@ -30,40 +42,116 @@ def load_template(path: Path, default: str) -> str:
         return default
 
 
-@dataclass
+TEMPLATE_FORMATTER = string.Formatter()
+
+# (literal, field_name, format_spec, conversion) as yielded by Formatter.parse.
+TemplateParts = list[tuple[str, Optional[str], str, Optional[str]]]
+
+
+def compile_template(template: str) -> TemplateParts:
+    """Split a format template into its literal and field parts once."""
+    parts = []
+    for literal, field_name, format_spec, conversion in TEMPLATE_FORMATTER.parse(
+        template
+    ):
+        if format_spec and "{" in format_spec:
+            raise RuntimeError(
+                f"Nested fields are not supported in templates: {{{field_name}}}"
+            )
+        parts.append((literal, field_name, format_spec or "", conversion))
+    return parts
+
+
+def render_field(value: str, format_spec: str, conversion: Optional[str]) -> str:
+    """Apply a field's conversion and format spec the way str.format would."""
+    if conversion:
+        value = TEMPLATE_FORMATTER.convert_field(value, conversion)
+    if format_spec or conversion:
+        return format(value, format_spec)
+    return value
+
+
+def render_template(parts: TemplateParts, values: dict[str, str]) -> str:
+    chunks = []
+    for literal, field_name, format_spec, conversion in parts:
+        chunks.append(literal)
+        if field_name is not None:
+            chunks.append(render_field(values[field_name], format_spec, conversion))
+    return "".join(chunks)
+
+
+EncodedTemplateParts = list[tuple[bytes, Optional[str], str, Optional[str]]]
+
+
+def encode_template(parts: TemplateParts) -> EncodedTemplateParts:
+    """Pre-encode the literal parts of a compiled template to UTF-8."""
+    return [
+        (literal.encode("utf-8"), field_name, format_spec, conversion)
+        for literal, field_name, format_spec, conversion in parts
+    ]
+
+
+def render_encoded_template(
+    parts: EncodedTemplateParts, values: dict[str, str]
+) -> bytes:
+    chunks = []
+    for literal, field_name, format_spec, conversion in parts:
+        chunks.append(literal)
+        if field_name is not None:
+            field = render_field(values[field_name], format_spec, conversion)
+            chunks.append(field.encode("utf-8"))
+    return b"".join(chunks)
+
+
+@dataclass(frozen=True, slots=True)
 class BotConfig:
     token: str
     repo_root: Path
     journal_root: Path
+    journal_git_root: Path
     local_tz: ZoneInfo
     git_user_name: str
     git_user_email: str
+    git_env: dict[str, str]
     note_template: str
     message_template: str
+    note_template_parts: TemplateParts
+    message_template_parts: EncodedTemplateParts
     poll_interval: float
+    poll_timeout: int
+    flush_interval: float
+    webhook_url: Optional[str]
+    webhook_listen: str
+    webhook_port: int
+    webhook_secret_token: Optional[str]
 
     @classmethod
     def from_env(cls) -> "BotConfig":
-        token = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("TELEGRAM_TOKEN")
+        """Read all settings from a single snapshot of the environment.
+
+        This is the only place settings are read; handlers use the config.
+        """
+        env = os.environ.copy()
+        token = env.get("TELEGRAM_BOT_TOKEN") or env.get("TELEGRAM_TOKEN")
         if not token:
             raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
 
-        repo_root = Path(os.getenv("REPO_ROOT", Path.cwd()))
+        repo_root = Path(env.get("REPO_ROOT", Path.cwd()))
         journal_root = repo_root / "journal"
 
-        git_user_name = os.getenv("GIT_USER_NAME") or os.getenv("GIT_AUTHOR_NAME")
-        git_user_email = os.getenv("GIT_USER_EMAIL") or os.getenv("GIT_AUTHOR_EMAIL")
+        git_user_name = env.get("GIT_USER_NAME") or env.get("GIT_AUTHOR_NAME")
+        git_user_email = env.get("GIT_USER_EMAIL") or env.get("GIT_AUTHOR_EMAIL")
         if not git_user_name or not git_user_email:
             raise RuntimeError(
                 "Missing git identity (GIT_USER_NAME and GIT_USER_EMAIL)"
             )
 
-        templates_root = Path(os.getenv("TEMPLATES_ROOT", Path.cwd()))
+        templates_root = Path(env.get("TEMPLATES_ROOT", Path.cwd()))
         note_template_path = Path(
-            os.getenv("NOTE_TEMPLATE_PATH", templates_root / "note_template.md")
+            env.get("NOTE_TEMPLATE_PATH", templates_root / "note_template.md")
         )
         message_template_path = Path(
-            os.getenv("MESSAGE_TEMPLATE_PATH", templates_root / "message_template.md")
+            env.get("MESSAGE_TEMPLATE_PATH", templates_root / "message_template.md")
         )
 
         note_template = load_template(
@@ -75,9 +163,16 @@ class BotConfig:
             default="## {time} telegram update\n\n{text}\n",
         )
 
-        poll_interval = float(os.getenv("POLL_INTERVAL", "10"))
+        poll_interval = float(env.get("POLL_INTERVAL", "10"))
+        poll_timeout = int(env.get("POLL_TIMEOUT", "30"))
+        flush_interval = float(env.get("FLUSH_INTERVAL", "5"))
 
-        tz_name = os.getenv("LOCAL_TIMEZONE")
+        webhook_url = env.get("WEBHOOK_URL") or None
+        webhook_listen = env.get("WEBHOOK_LISTEN", "0.0.0.0")
+        webhook_port = int(env.get("WEBHOOK_PORT", "8443"))
+        webhook_secret_token = env.get("WEBHOOK_SECRET_TOKEN") or None
+
+        tz_name = env.get("LOCAL_TIMEZONE")
         local_tz = ZoneInfo(tz_name) if tz_name else datetime.now().astimezone().tzinfo
         if local_tz is None:
             local_tz = ZoneInfo("UTC")
@@ -86,15 +181,43 @@ class BotConfig:
             token=token,
             repo_root=repo_root,
             journal_root=journal_root,
+            journal_git_root=journal_root.relative_to(repo_root),
             local_tz=local_tz,
             git_user_name=git_user_name,
             git_user_email=git_user_email,
+            git_env={
+                **env,
+                "GIT_AUTHOR_NAME": git_user_name,
+                "GIT_AUTHOR_EMAIL": git_user_email,
+                "GIT_COMMITTER_NAME": git_user_name,
+                "GIT_COMMITTER_EMAIL": git_user_email,
+            },
             note_template=note_template,
             message_template=message_template,
+            note_template_parts=compile_template(note_template),
+            message_template_parts=encode_template(compile_template(message_template)),
             poll_interval=poll_interval,
+            poll_timeout=poll_timeout,
+            flush_interval=flush_interval,
+            webhook_url=webhook_url,
+            webhook_listen=webhook_listen,
+            webhook_port=webhook_port,
+            webhook_secret_token=webhook_secret_token,
         )
 
 
+@dataclass(frozen=True, slots=True)
+class PendingEntry:
+    """A rendered message waiting for the next flush to write and commit it."""
+
+    note_path: Path
+    note_for_git: Path
+    local_time: datetime
+    entry: bytes
+    stamp: str
+    waiter: asyncio.Future
+
+
 def ensure_directories(path: Path) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -107,47 +230,144 @@ def ensure_note_initialized(
     needs_template = not note_path.exists() or note_path.stat().st_size == 0
     if needs_template:
         header_date = local_time.strftime("%Y-%m-%d, %A")
-        content = config.note_template.format(date=header_date)
+        content = render_template(config.note_template_parts, {"date": header_date})
         if not content.endswith("\n"):
             content += "\n"
         note_path.write_text(content, encoding="utf-8")
 
 
 def format_entry(
-    text: str, author: Optional[str], local_time: datetime, config: BotConfig
-) -> str:
+    text: str, author: Optional[str], time_str: str, config: BotConfig
+) -> bytes:
     clean_text = text.strip()
     author_block = f"\n\nfrom: {author}" if author else ""
-    rendered = config.message_template.format(
-        time=f"{local_time:%H:%M}",
-        text=clean_text,
-        author_block=author_block,
+    rendered = render_encoded_template(
+        config.message_template_parts,
+        {
+            "time": time_str,
+            "text": clean_text,
+            "author_block": author_block,
+        },
     )
-    if not rendered.endswith("\n"):
-        rendered += "\n"
+    if not rendered.endswith(b"\n"):
+        rendered += b"\n"
     return rendered
 
 
-def run_git(repo_root: Path, *args: str) -> bool:
-    result = subprocess.run(
-        ["git", *args],
+async def exec_command(
+    repo_root: Path,
+    *cmd: str,
+    env: Optional[dict[str, str]] = None,
+    capture_stdout: bool = False,
+) -> tuple[int, bytes, bytes]:
+    """Run a command, piping stdout only when the caller needs to read it."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
         cwd=repo_root,
-        capture_output=True,
-        text=True,
+        env=env,
+        stdout=(
+            asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL
+        ),
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    return proc.returncode, out or b"", err
+
+
+async def run_git(config: BotConfig, *args: str) -> bool:
+    returncode, _, err = await exec_command(
+        config.repo_root, "git", *GIT_FAST_FLAGS, *args, env=config.git_env
     )
-    if result.returncode != 0:
-        logger.error("git %s failed: %s", " ".join(args), result.stdout + result.stderr)
+    if returncode != 0:
+        logger.error(
+            "git %s failed: %s", " ".join(args), err.decode("utf-8", "replace")
+        )
         return False
+    return True
+
 
-    if result.stdout.strip():
-        logger.info(result.stdout.strip())
+async def read_git(config: BotConfig, *args: str) -> Optional[str]:
+    """Run a git command and return its stdout, or None on failure."""
+    returncode, out, err = await exec_command(
+        config.repo_root,
+        "git",
+        *GIT_FAST_FLAGS,
+        *args,
+        env=config.git_env,
+        capture_stdout=True,
+    )
+    if returncode != 0:
+        logger.error(
+            "git %s failed: %s", " ".join(args), err.decode("utf-8", "replace")
+        )
+        return None
+    return out.decode("utf-8", "replace")
+
+
+def commit_notes(
+    repo: pygit2.Repository, paths: list[Path], message: str, config: BotConfig
+) -> bool:
+    """Stage and commit the given repo-relative paths in-process.
+
+    Callers have just appended to every path, so a tree identical to HEAD's
+    means the writes never reached the tracked files and is a failure. Also
+    returns False without touching the index while a merge or rebase is pending.
+    """
+    try:
+        if repo.state() != pygit2.enums.RepositoryState.NONE or repo.head_is_detached:
+            logger.error("Refusing to commit: repository is mid-operation or detached")
+            return False
+
+        index = repo.index
+        # Pick up anything a git subprocess (e.g. rebase) wrote to the index.
+        index.read()
+        if index.conflicts is not None:
+            logger.error("Refusing to commit: the index has unresolved conflicts")
+            return False
+
+        for path in paths:
+            index.add(path.as_posix())
+        index.write()
+        tree = index.write_tree()
+        parents = []
+        if not repo.head_is_unborn:
+            head_commit = repo.head.peel(pygit2.Commit)
+            if head_commit.tree_id == tree:
+                logger.error(
+                    "Appended notes left the tree unchanged: %s",
+                    ", ".join(map(str, paths)),
+                )
+                return False
+            parents = [head_commit.id]
+        signature = pygit2.Signature(config.git_user_name, config.git_user_email)
+        repo.create_commit("HEAD", signature, signature, message, tree, parents)
+    except pygit2.GitError:
+        logger.exception("git commit failed")
+        return False
     return True
 
 
-def ensure_git_identity(config: BotConfig) -> bool:
-    ok_name = run_git(config.repo_root, "config", "user.name", config.git_user_name)
-    ok_email = run_git(config.repo_root, "config", "user.email", config.git_user_email)
-    return ok_name and ok_email
+async def sync_with_upstream(config: BotConfig) -> tuple[bool, bool]:
+    """Fetch and rebase only when the upstream has commits HEAD lacks.
+
+    Returns (synced, rebased). rebased is True whenever a rebase ran, even one
+    that failed and was aborted, since either may rewrite files on disk.
+    """
+    if not await run_git(config, "fetch", "--quiet"):
+        return False, False
+
+    behind = await read_git(config, "rev-list", "--count", "HEAD..@{u}")
+    if behind is None:
+        return False, False
+
+    if int(behind) == 0:
+        return True, False
+    if await run_git(config, "rebase", "--no-verify", "@{u}"):
+        return True, True
+
+    # Never leave the checkout mid-rebase on a detached HEAD.
+    await run_git(config, "rebase", "--abort")
+    return False, True
 
 
 async def react_to_outcome(message, bot: Bot, success: bool) -> None:
@@ -177,6 +397,82 @@ async def react_to_outcome(message, bot: Bot, success: bool) -> None:
         logger.exception("Failed to set reaction")
 
 
+def build_author(user: User) -> Optional[str]:
+    parts = [
+        user.full_name or "",
+        f"@{user.username}" if user.username else "",
+    ]
+    return " ".join(part for part in parts if part).strip() or None
+
+
+def note_file_is_current(bot_data: dict, note_path: Path) -> bool:
+    """Check the cached handle still points at the note file on disk.
+
+    Rebases, resets or edits made outside the bot can replace the file, and a
+    stale handle would keep appending to the unlinked copy.
+    """
+    cached_path, fh = bot_data["note_file"]
+    if fh is None or cached_path != note_path:
+        return False
+    try:
+        on_disk = os.stat(note_path)
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(fh.fileno())
+    return (opened.st_ino, opened.st_dev) == (on_disk.st_ino, on_disk.st_dev)
+
+
+def open_note_file(bot_data: dict, note_path: Path) -> BinaryIO:
+    close_note_file(bot_data)
+    fh = note_path.open("ab")
+    bot_data["note_file"] = (note_path, fh)
+    return fh
+
+
+def close_note_file(bot_data: dict) -> None:
+    _, fh = bot_data["note_file"]
+    if fh is not None:
+        fh.close()
+    bot_data["note_file"] = (None, None)
+
+
+def queue_message(
+    bot_data: dict, text: str, author: Optional[str], local_time: datetime
+) -> asyncio.Future:
+    """Render a message and queue it for the next flush.
+
+    The returned future resolves to whether the flush pushed it.
+    """
+    config: BotConfig = bot_data["config"]
+
+    # One strftime call covers the note directory, entry time and commit stamp.
+    day_dir, time_str, stamp = local_time.strftime(
+        "%Y/%m/%d|%H:%M|%Y-%m-%d %H:%M"
+    ).split("|")
+    note_date = local_time.date()
+    cached_date, note_path, note_for_git = bot_data["daily_note"]
+    if note_date != cached_date:
+        dated_note = Path(day_dir, "note.md")
+        note_path = config.journal_root / dated_note
+        note_for_git = config.journal_git_root / dated_note
+        bot_data["daily_note"] = (note_date, note_path, note_for_git)
+
+    # The flush writes the entry once the checkout is synced with upstream.
+    waiter = asyncio.get_running_loop().create_future()
+    bot_data["pending_entries"].append(
+        PendingEntry(
+            note_path=note_path,
+            note_for_git=note_for_git,
+            local_time=local_time,
+            entry=format_entry(text, author, time_str, config),
+            stamp=stamp,
+            waiter=waiter,
+        )
+    )
+    bot_data["pending_event"].set()
+    return waiter
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.effective_message
     if not message or not message.text:
@@ -185,50 +481,121 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     config: BotConfig = context.bot_data["config"]
     success = False
 
-    local_time = message.date.astimezone(config.local_tz)
-    note_path = (
-        config.journal_root
-        / f"{local_time:%Y}"
-        / f"{local_time:%m}"
-        / f"{local_time:%d}"
-        / "note.md"
-    )
-
     try:
-        if not run_git(config.repo_root, "pull", "--rebase"):
-            return
+        author = None
+        user = message.from_user
+        if user:
+            # Key on the name fields too so renamed senders aren't stale.
+            author_key = (user.id, user.username, user.first_name, user.last_name)
+            author_cache: dict = context.bot_data["author_cache"]
+            if author_key in author_cache:
+                author = author_cache[author_key]
+            else:
+                author = build_author(user)
+                author_cache[author_key] = author
+
+        local_time = message.date.astimezone(config.local_tz)
+        success = await queue_message(
+            context.bot_data, message.text, author, local_time
+        )
+    except Exception:
+        logger.exception("Failed to process message")
+    finally:
+        await react_to_outcome(message, context.bot, success)
 
-        ensure_note_initialized(note_path, local_time, config)
 
-        author = None
-        if message.from_user:
-            parts = [
-                message.from_user.full_name or "",
-                f"@{message.from_user.username}" if message.from_user.username else "",
-            ]
-            author = " ".join(part for part in parts if part).strip() or None
+def append_entries(bot_data: dict, entries: list[PendingEntry]) -> None:
+    config: BotConfig = bot_data["config"]
+    for pending in entries:
+        if note_file_is_current(bot_data, pending.note_path):
+            fh = bot_data["note_file"][1]
+        else:
+            # Only a new, replaced or removed note needs the template check.
+            ensure_note_initialized(pending.note_path, pending.local_time, config)
+            fh = open_note_file(bot_data, pending.note_path)
 
-        with note_path.open("a", encoding="utf-8") as fh:
-            fh.write(format_entry(message.text, author, local_time, config))
+        fh.write(pending.entry)
+        # Buffered writes retry short writes; flush so the commit sees it all.
+        fh.flush()
 
-        note_for_git = note_path
-        if note_path.is_relative_to(config.repo_root):
-            note_for_git = note_path.relative_to(config.repo_root)
 
-        if not run_git(config.repo_root, "add", str(note_for_git)):
-            return
+async def flush_pending(bot_data: dict) -> None:
+    """Write, commit and push every message queued since the previous flush."""
+    config: BotConfig = bot_data["config"]
+    success = False
 
-        commit_msg = f"note: telegram {local_time:%Y-%m-%d %H:%M}"
-        if not run_git(config.repo_root, "commit", "-m", commit_msg):
+    async with bot_data["git_lock"]:
+        bot_data["pending_event"].clear()
+        entries: list[PendingEntry] = bot_data["pending_entries"]
+        bot_data["pending_entries"] = []
+        if not entries:
             return
 
-        success = run_git(config.repo_root, "push")
-        if not success:
-            logger.error("git push failed")
-    except Exception:
-        logger.exception("Failed to process message")
-    finally:
-        await react_to_outcome(message, context.bot, success)
+        try:
+            commit_msg = f"note: telegram {entries[-1].stamp}"
+            if len(entries) > 1:
+                commit_msg += f" ({len(entries)} messages)"
+
+            # Sync while the tree is clean, like the pull before each write
+            # used to, so upstream edits to today's note never conflict.
+            repo: pygit2.Repository = bot_data["repo"]
+            synced, rebased = await sync_with_upstream(config)
+            if rebased:
+                # A rebase, even an aborted one, may rewrite note files on disk.
+                close_note_file(bot_data)
+
+            if synced:
+                append_entries(bot_data, entries)
+                paths = sorted({pending.note_for_git for pending in entries})
+                success = commit_notes(
+                    repo, paths, commit_msg, config
+                ) and await run_git(config, "push", "--no-verify")
+            if not success:
+                logger.error("git sync failed")
+        except Exception:
+            logger.exception("Failed to flush notes")
+        finally:
+            for pending in entries:
+                if not pending.waiter.done():
+                    pending.waiter.set_result(success)
+
+
+def init_bot_data(bot_data: dict, config: BotConfig) -> None:
+    bot_data["config"] = config
+    bot_data["repo"] = pygit2.Repository(str(config.repo_root))
+    bot_data["git_lock"] = asyncio.Lock()
+    bot_data["daily_note"] = (None, None, None)
+    bot_data["note_file"] = (None, None)
+    bot_data["author_cache"] = {}
+    bot_data["pending_entries"] = []
+    bot_data["pending_event"] = asyncio.Event()
+
+
+async def flush_worker(bot_data: dict) -> None:
+    config: BotConfig = bot_data["config"]
+    while True:
+        await bot_data["pending_event"].wait()
+        # Give a burst of messages time to land in the same commit.
+        await asyncio.sleep(config.flush_interval)
+        await flush_pending(bot_data)
+
+
+async def on_startup(application: Application) -> None:
+    application.bot_data["flush_task"] = asyncio.create_task(
+        flush_worker(application.bot_data)
+    )
+
+
+async def on_shutdown(application: Application) -> None:
+    flush_task: Optional[asyncio.Task] = application.bot_data.get("flush_task")
+    if flush_task:
+        flush_task.cancel()
+        try:
+            await flush_task
+        except asyncio.CancelledError:
+            pass
+    await flush_pending(application.bot_data)
+    close_note_file(application.bot_data)
 
 
 def main() -> None:
@@ -236,18 +603,38 @@ def main() -> None:
     config = BotConfig.from_env()
     logger.info("Starting bot; writing notes under %s", config.journal_root)
 
-    if not ensure_git_identity(config):
-        raise SystemExit("Failed to configure git identity")
-
-    application = ApplicationBuilder().token(config.token).build()
-    application.bot_data["config"] = config
+    application = (
+        ApplicationBuilder()
+        .token(config.token)
+        # Multiplex concurrent handler calls over one HTTP/2 connection.
+        .http_version("2")
+        .get_updates_http_version("2")
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    init_bot_data(application.bot_data, config)
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
     )
 
-    application.run_polling(
-        poll_interval=config.poll_interval, allowed_updates=["message"]
-    )
+    if config.webhook_url:
+        logger.info("Receiving updates via webhook %s", config.webhook_url)
+        application.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=urlparse(config.webhook_url).path.lstrip("/"),
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret_token,
+            allowed_updates=["message"],
+        )
+    else:
+        application.run_polling(
+            poll_interval=config.poll_interval,
+            timeout=config.poll_timeout,
+            allowed_updates=["message"],
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""Run flush_pending against a temporary bare upstream."""
+
+import asyncio
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import pygit2
+import pytest
+
+import main
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+NOTE = "journal/2026/10/14/note.md"
+
+
+def git(cwd: Path, *args: str) -> str:
+    result = subprocess.run(
+        [
+            "git",
+            "-c",
+            "user.name=Other",
+            "-c",
+            "user.email=other@example.com",
+            *args,
+        ],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    remote = tmp_path / "remote.git"
+    checkout = tmp_path / "checkout"
+    git(tmp_path, "init", "--quiet", "--bare", "--initial-branch=main", str(remote))
+    git(tmp_path, "init", "--quiet", "--initial-branch=main", str(checkout))
+    git(checkout, "commit", "--quiet", "--allow-empty", "-m", "init")
+    git(checkout, "remote", "add", "origin", str(remote))
+    git(checkout, "push", "--quiet", "-u", "origin", "main")
+
+    monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "token")
+    monkeypatch.setenv("REPO_ROOT", str(checkout))
+    monkeypatch.setenv("GIT_USER_NAME", "Foam Bot")
+    monkeypatch.setenv("GIT_USER_EMAIL", "bot@example.com")
+    monkeypatch.setenv("TEMPLATES_ROOT", str(PROJECT_ROOT))
+    monkeypatch.setenv("LOCAL_TIMEZONE", "UTC")
+    return tmp_path
+
+
+def pushed_note(tmp_path: Path) -> str:
+    return git(tmp_path / "remote.git", "show", f"main:{NOTE}")
+
+
+def append_upstream(tmp_path: Path, line: str) -> None:
+    """Append to today's note from another clone, as a Foam user would."""
+    other = tmp_path / "other"
+    if not other.exists():
+        git(tmp_path, "clone", "--quiet", str(tmp_path / "remote.git"), str(other))
+    git(other, "pull", "--quiet")
+    with (other / NOTE).open("a", encoding="utf-8") as fh:
+        fh.write(f"{line}\n")
+    git(other, "commit", "--quiet", "-am", line)
+    git(other, "push", "--quiet")
+
+
+async def flush(bot_data: dict, *texts: str) -> list[tuple[str, bool]]:
+    config: main.BotConfig = bot_data["config"]
+    waiters = []
+    for minute, text in enumerate(texts):
+        local_time = datetime(2026, 10, 14, 9, minute, tzinfo=config.local_tz)
+        waiters.append((text, main.queue_message(bot_data, text, None, local_time)))
+    await main.flush_pending(bot_data)
+    return [(text, waiter.result()) for text, waiter in waiters]
+
+
+def assert_saved_entries_pushed(tmp_path: Path, results: list[tuple[str, bool]]):
+    note = pushed_note(tmp_path)
+    for text, saved in results:
+        if saved:
+            assert text in note
+
+
+def assert_checkout_clean(bot_data: dict) -> None:
+    repo: pygit2.Repository = bot_data["repo"]
+    assert repo.state() == pygit2.enums.RepositoryState.NONE
+    assert not repo.head_is_detached
+    assert "<<<<<<<" not in (bot_data["config"].repo_root / NOTE).read_text()
+
+
+def run_scenario(scenario) -> None:
+    async def runner():
+        bot_data: dict = {}
+        main.init_bot_data(bot_data, main.BotConfig.from_env())
+        try:
+            await scenario(bot_data)
+        finally:
+            main.close_note_file(bot_data)
+
+    asyncio.run(runner())
+
+
+def test_flush_pushes_batch(upstream):
+    async def scenario(bot_data):
+        results = await flush(bot_data, "entry one", "entry two")
+
+        assert [saved for _, saved in results] == [True, True]
+        note = pushed_note(upstream)
+        assert note.startswith("---\ntags: []\n---\n\n# 2026-10-14, Wednesday\n")
+        assert note.index("entry one") < note.index("entry two")
+        assert_saved_entries_pushed(upstream, results)
+
+    run_scenario(scenario)
+
+
+def test_flush_recovers_after_push_failure(upstream):
+    async def scenario(bot_data):
+        checkout = bot_data["config"].repo_root
+        git(checkout, "remote", "set-url", "--push", "origin", str(upstream / "gone"))
+        failed = await flush(bot_data, "entry offline")
+        assert failed == [("entry offline", False)]
+
+        git(checkout, "config", "--unset", "remote.origin.pushurl")
+        results = await flush(bot_data, "entry online")
+
+        assert results == [("entry online", True)]
+        # The earlier commit goes out with the next push.
+        assert "entry offline" in pushed_note(upstream)
+        assert_saved_entries_pushed(upstream, failed + results)
+        assert_checkout_clean(bot_data)
+
+    run_scenario(scenario)
+
+
+def test_flush_rebases_over_upstream_edit(upstream):
+    async def scenario(bot_data):
+        first = await flush(bot_data, "entry before")
+        append_upstream(upstream, "edited elsewhere")
+        second = await flush(bot_data, "entry after")
+
+        assert [saved for _, saved in first + second] == [True, True]
+        note = pushed_note(upstream)
+        assert (
+            note.index("entry before")
+            < note.index("edited elsewhere")
+            < note.index("entry after")
+        )
+        assert_saved_entries_pushed(upstream, first + second)
+        assert_checkout_clean(bot_data)
+
+    run_scenario(scenario)
+
+
+def test_flush_survives_conflicting_upstream_edit(upstream):
+    async def scenario(bot_data):
+        checkout = bot_data["config"].repo_root
+        first = await flush(bot_data, "entry kept")
+
+        # An unpushed local commit that conflicts with an upstream append.
+        git(checkout, "remote", "set-url", "--push", "origin", str(upstream / "gone"))
+        unpushed = await flush(bot_data, "entry unpushed")
+        git(checkout, "config", "--unset", "remote.origin.pushurl")
+        append_upstream(upstream, "edited elsewhere")
+
+        conflicted = await flush(bot_data, "entry conflicted")
+        assert conflicted == [("entry conflicted", False)]
+        assert_checkout_clean(bot_data)
+
+        # Recovering by hand rewrites the note under the cached handle.
+        git(checkout, "reset", "--quiet", "--hard", "@{u}")
+        recovered = await flush(bot_data, "entry recovered")
+
+        assert recovered == [("entry recovered", True)]
+        assert_saved_entries_pushed(upstream, first + unpushed + conflicted + recovered)
+        assert_checkout_clean(bot_data)
+
+    run_scenario(scenario)